@@ -16,7 +16,7 @@
 # This script can be used with model data produced with both 360_day and gregorian calendars
 # This is controlled by an input argument: choose 'postprocessing' for offline and 'batch' for running within a UM suite 
 # How to call the script on the command line: 
-# python3 UM_to_flightrack.py -i 'UM_inputdir' -t 'trackdir' -d 'YYYYMM' -n 'n_months' -r 'runid' -p 'pp_stream'  -o 'outdir' -m 'method' -c 'True' postprocessing -s 'select_stash'
+# python3 UM_to_flightrack.py -i 'UM_inputdir' -t 'trackdir' -d 'YYYYMM' -n 'n_months' -r 'runid' -p 'pp_stream'  -o 'outdir' -m 'method' -b 'backend' -c 'True' -w 'time_window' --precision 'precision' --significant_digits 'digits' --drop_masked 'True' postprocessing -s 'select_stash'
 # where:
 # 'UM_inputdir' = directory containing the UM hourly pp or fieldsfiles
 # 'trackdir' = directory containing input flight track netcdf files
@@ -29,7 +29,24 @@
 #            2) for batch running, default is $DATAM
 #               If outdir is present output is also copied to outdir
 # 'interpolation_method' = choose between 'lin' (linear) and 'nn' (nearest neighbour); (optional; default=lin)
+# 'backend' = choose between 'cis' and 'kdtree' (optional; default=cis). 'kdtree' only works with 'nn' and uses a spatial index
+#             built once per grid from the 2-D latitude/longitude, so rotated pole and limited area grids are supported
 # -c 'True' produces a model climatology for a small set of flights, e.g. from a field campaign. (optional; default='False')
+# 'time_window' = number of hourly time steps read and collocated at the time, e.g. 2 collocates pairs of adjacent hours
+#                 so memory stays bounded for high resolution grids (optional; default=0 reads and collocates the full day)
+# 'precision' = precision of collocated variables in monthly files: 'float64', 'float32' or 'int16' (packed with scale_factor
+#               and add_offset); (optional; default=float64). Monthly files are also zlib compressed if any of these options is set
+# 'significant_digits' = quantise collocated variables in monthly files to this number (at least 1) of significant digits;
+#                        with int16 the values are quantised before packing (optional)
+# 'drop_masked' = set to 'True' to drop flight points where the model variable is masked from monthly files (optional; default=False)
+# 'shard' = optional sharded execution for long reprocessing campaigns; choose between:
+#     'coordinator' writes one work unit per (month, day, stash) to the shared 'queue_dir'
+#     'worker' claims work units (with lock files) and writes daily files; start as many as needed on any node
+#     'merge' writes the monthly CMIP6-named files once all work units of a month are done
+#     All steps need the same arguments and a 'queue_dir' on a shared filesystem. Workers touch the lock of the unit
+#     they process; a lock not touched for 'lock_timeout' seconds (optional; default=600), or whose process died on the
+#     same host, is reclaimed by the next worker. Units that fail are recorded in 'queue_dir'/failed and reported by
+#     merge, which exits with an error while any unit of a month is failed or not done
 # 'batch' = if selected the script is expected to run within a UM suite; you can also input: 
 #     archive_hourly =  set to 'False' if you do not want to archive hourly UM input files (optional; default=True)
 # 'postprocessing' = if selected the script is expected to run outside a UM suite; you can also input:
@@ -38,6 +55,8 @@
 ## EXAMPLES:
 # python3 UM_to_flightrack.py -i ~/nethome/data/CIS_TESTS/UM_Input/cm020 -t ~/nethome/data/CIS_TESTS/Flights -d 201001 -n 1 -r cm020 -p l -o ~/data/CIS_TESTS/Out_test postprocessing --select_stash 51001 51009
 # python3 UM_to_flightrack.py -i ~/data/CIS_TESTS/UM_Input -t ~/data/CIS_TESTS/Flights -d 201003 -r cm020 -p l -o ~/data/CIS_TESTS/Out_test batch --archive_hourly False 
+# python3 UM_to_flightrack.py -i ~/data/CIS_TESTS/UM_Input -t ~/data/CIS_TESTS/Flights -d 198001 -n 360 -r cm020 -p l -o ~/data/CIS_TESTS/Out_test --shard coordinator --queue_dir ~/data/CIS_TESTS/Queue postprocessing
+#     followed by the same command with '--shard worker' (on as many nodes as needed) and finally '--shard merge'
 #######################################################################################
 
 ######################################
@@ -122,6 +141,387 @@ def cis_from_cf(cfvar):
 
     return cisvar
 
+# Subset flight track (cis ungridded data) to selected points -------------------------------
+def subset_track(track, index):
+    import copy
+    from cis.data_io.ungridded_data import UngriddedData
+    from cis.data_io.Coord import Coord, CoordList
+
+    coords=[]
+    for coord in track.coords():
+        coord_metadata=copy.copy(coord.metadata)
+        coord_metadata.shape=coord.data[index].shape
+        coords.append(Coord(coord.data[index], coord_metadata, axis=coord.axis))
+
+    metadata=copy.copy(track.metadata)
+    metadata.shape=track.data[index].shape
+
+    return UngriddedData(data=track.data[index], metadata=metadata, coords=CoordList(coords))
+
+# Convert cf variable to cis variable and collocate onto flight track -----------------------
+def collocate_cfvar(var, track, method, new_time_units):
+    # Move data to cis variable format (cf.field.Field to cis.data_io.gridded_data.GriddedData)
+    try:
+        cisvar=cis_from_cf(var)
+    except BaseException as err:
+        # If file does not exists or problems reading it:
+        print("Error: {0}".format(err))
+        raise Exception
+
+    # Convert working_var_cis to same time units as flight data
+    cisvar.coord("time").convert_units(new_time_units)
+    # Collocate
+    trackvar=cisvar.collocated_onto(track, how=method)   #cis.data_io.ungridded_data.UngriddedDataList
+
+    return trackvar[0]
+
+# Collocate cf variable onto flight track reading a few hourly time steps at the time -------
+def collocate_in_time_windows(var, track, method, new_time_units, time_window):
+    import copy
+    from cis.data_io.ungridded_data import UngriddedData
+
+    # Position of the time axis in the field data and model times in the same units as the flight track
+    time_key=var.dimension_coordinate('T', key=True)
+    t_pos=var.get_data_axes().index(var.get_data_axes(time_key)[0])
+    t_coord=var.dimension_coordinate(time_key)
+    model_times=cf_units.Unit(t_coord.units).convert(t_coord.array, new_time_units)
+    n_times=len(model_times)
+
+    # Nothing to gain from windowing if the whole day fits in one window
+    if time_window < 2 or n_times <= time_window:
+        return collocate_cfvar(var, track, method, new_time_units)
+
+    # Empty track: collocate onto it with the first window only (so the output still has the variable metadata)
+    if len(track.data) == 0:
+        window=[slice(None)] * var.ndim
+        window[t_pos]=slice(0, time_window)
+        return collocate_cfvar(var[tuple(window)], track, method, new_time_units)
+
+    # Windows overlap by one time step so that each flight point lies between two model times of its window
+    starts=list(range(0, n_times - 1, time_window - 1))
+    # Assign each flight point to a window (points outside the model day go to the first or last window)
+    track_times=track.coord("time").data
+    which=np.searchsorted(model_times[starts], track_times, side='right') - 1
+    which=np.clip(which, 0, len(starts) - 1)
+
+    collocated=None
+    for nw in range(len(starts)):
+        index=np.where(which == nw)[0]
+        if len(index) == 0:
+            continue
+        # Only this window is read from the cf field and converted to cis
+        window=[slice(None)] * var.ndim
+        window[t_pos]=slice(starts[nw], min(starts[nw] + time_window, n_times))
+        trackvar=collocate_cfvar(var[tuple(window)], subset_track(track, index), method, new_time_units)
+        if collocated is None:
+            collocated=np.ma.masked_all(track.data.shape, dtype=trackvar.data.dtype)
+            metadata=copy.copy(trackvar.metadata)
+            metadata.shape=track.data.shape
+        collocated[index]=trackvar.data
+
+    return UngriddedData(data=collocated, metadata=metadata, coords=track.coords())
+
+# Find days within UM cycle for which flight track data exists -------------------------------
+def find_track_dates(trackdir, cycle_date, multi_year):
+    import os
+
+    files=sorted(os.listdir(trackdir))
+    if multi_year == True:
+        # Find date location in filenames
+        filename0=files[0]
+        date0="".join([n for n in filename0 if n.isdigit()])
+        date_start = filename0.index(date0)
+        # Select dates to read flight data (with same month as cycle date)
+        flight_files=[filename for filename in files if filename[date_start + 4 : date_start + 6] == cycle_date[4:6]]
+        # Select dates with same month and day as flight dates (this will produce output for multiple years for each flight)  
+        read_dates = [cycle_date[0:4] + filename[date_start + 4 : date_start + 8] for filename in flight_files]
+        flight_dates= [filename[date_start : date_start + 8] for filename in flight_files]
+    else:
+        # Select dates with same year, month and date as flight dates
+        flight_files=[filename for filename in files if cycle_date in filename]
+        read_dates=[filename[filename.index(cycle_date):filename.index(cycle_date)+8] for filename in flight_files]
+        flight_dates=read_dates
+
+    return read_dates, flight_dates
+
+# Read air pressure and campaign name from flight track file for one day ---------------------
+def read_flight_track(trackdir, f_date, m_date, multi_year):
+    # Define flight track filename for dates within the current UM cycle
+    trackfile=trackdir + '*' + f_date +'*.nc'
+    print('Reading ', trackfile)
+    try:
+        flight=cis.read_data_list(trackfile,['air_pressure','campaign'])
+    except OSError as err:
+        # If file does not exists or problems reading it: 
+        print("Error: {0}".format(err))
+        raise Exception
+
+    if multi_year == True:
+        # Convert time to start of flight month 
+        start_of_flight_month="days since "+f_date[0:4]+"-"+f_date[4:6]+"-01"
+        new_time_units_1 = cf_units.Unit(start_of_flight_month, calendar=flight[0].coord("time").units.calendar)
+        flight[0].coord("time").convert_units(new_time_units_1)
+        # Save time array
+        saved_time_data=copy.deepcopy(flight[0].coord("time").data)
+        # Now convert time to start of model month
+        start_of_model_month="days since "+m_date[0:4]+"-"+m_date[4:6]+"-01"
+        new_time_units_2 = cf_units.Unit(start_of_model_month, calendar=flight[0].coord("time").units.calendar)
+        flight[0].coord("time").convert_units(new_time_units_2)
+        # Replace time array with previously saved time array
+        flight[0].coord("time").data=saved_time_data
+
+    # Convert CIS time units to common starting point
+    new_time_units = cf_units.Unit("days since 1900-01-01", calendar=flight[0].coord("time").units.calendar)
+    flight.coord("time").convert_units(new_time_units)
+
+    # Convert campaigns name to 8 digit integer (campaign code) and write into history metadata)
+    c_data = copy.deepcopy(flight[1].data)
+    c_names = list(dict.fromkeys(c_data))  # remove duplicates from list
+    c_codes = [generate_campaign_code(name) for name in c_names]
+    campaigns=dict(zip(c_names, c_codes))
+    # convert campaign names to campaign codes and list to numpy array
+    flight[1].data=np.array([campaigns[data] for data in c_data])
+
+    return flight, new_time_units, campaigns
+
+# Read model variables and Heaviside functions for one day -----------------------------------
+def read_model_data(infile, select_stash, select_source=None):
+    heaviside_51=None
+    heaviside_30=None
+
+    print('Reading', infile)
+    if select_source != None:
+        # Read a single variable selected by its UM stash source, e.g. m01s00i004 (this produces a cf.Fieldlist)
+        try:
+            reading_vars=cf.read(infile,select='um_stash_source='+select_source)
+        except OSError as err:
+            print("Error: {0}".format(err))
+            raise Exception
+        else:
+            # Read Heaviside step functions
+            if select_source[4:6] == '51' or select_source[4:6] == '52':
+                heaviside_51=cf.read(infile,select='stash_code=51999')[0] #cf.field.Field
+            if select_source[4:6] == '30':
+                heaviside_30=cf.read(infile,select='stash_code=30301')[0] #cf.field.Field
+    elif select_stash != None:
+        # Read only selected variables (this produces a cf.Fieldlist)
+        try:
+            reading_vars=cf.read(infile,select=['stash_code='+name for name in select_stash])
+        except OSError as err:
+            print("Error: {0}".format(err))
+            raise Exception
+        else:
+            read_h51=['true' for name in select_stash if name[0:2] == '51' or name[0:2] == '52']
+            read_h30=['true' for name in select_stash if name[0:2] == '30']
+            # Read Heaviside step functions
+            if len(read_h51) >= 1:
+                heaviside_51=cf.read(infile,select='stash_code=51999')[0] #cf.field.Field
+            if len(read_h30) >= 1:
+                heaviside_30=cf.read(infile,select='stash_code=30301')[0] #cf.field.Field
+    else:
+        # Reading all variables in the pp stream (this produces a cf.Fieldlist)
+        try:
+            reading_vars=cf.read(infile)
+        except OSError as err:
+            # If file does not exists or problems reading it:
+            print("Error: {0}".format(err))
+            raise Exception
+        else:
+            # Extract Heaviside step functions from reading_vars (if heaviside is not there this is an empty list)
+            h51 = [var for var in reading_vars if var.get_property("um_stash_source") == "m01s51i999"]
+            h30 = [var for var in reading_vars if var.get_property("um_stash_source") == "m01s30i301"]
+            if len(h51) >= 1:
+                heaviside_51 = h51[0]
+            if len(h30) >= 1:
+                heaviside_30 = h30[0]
+
+    return reading_vars, heaviside_51, heaviside_30
+
+# Check if a field is a Heaviside function ---------------------------------------------------
+def is_heaviside(var):
+    return var.get_property("um_stash_source") == "m01s51i999" or var.get_property("um_stash_source") == "m01s30i301"
+
+# Divide field by Heaviside function if required --------------------------------------------
+def apply_heaviside(var, heaviside_51, heaviside_30):
+    # For section 51 and 52
+    if var.get_property('um_stash_source')[0:6] == 'm01s51' or var.get_property('um_stash_source')[0:6] == 'm01s52':
+        # Check that the appropriate Heaviside function has been read
+        if heaviside_51 is not None:
+            print('Dividing field by Heaviside step function')
+            var = var/heaviside_51
+        else:
+            raise Exception('Heaviside function is required for section 51 or 52: add 51999 to UM output')
+
+    # For section 30
+    if var.get_property('um_stash_source')[0:6] == 'm01s30':
+    # Check that the appropriate Heaviside function has been read
+        if heaviside_30 is not None:
+            print('Dividing field by Heaviside step function')
+            var = var/heaviside_30
+        else:
+            raise Exception('Heaviside function is required for section 30: add 30301 to output')
+
+    return var
+
+# Divide by Heaviside function if required and collocate one stash onto flight track ---------
+def collocate_stash(var, heaviside_51, heaviside_30, flight, method, new_time_units, time_window, backend):
+    print('Processing ',var.get_property("um_stash_source"))
+
+    var = apply_heaviside(var, heaviside_51, heaviside_30)
+
+    # Collocate (with the spatial index, or with cis either the full day at once or a few hourly time steps at the time)
+    if backend == 'kdtree':
+        from kdtree_collocation import collocate_kdtree
+        flight[0]=collocate_kdtree(var, flight[0], new_time_units)
+    elif time_window > 0:
+        flight[0]=collocate_in_time_windows(var, flight[0], method, new_time_units, time_window)
+    else:
+        flight[0]=collocate_cfvar(var, flight[0], method, new_time_units)
+
+    return var.get_property('um_stash_source')
+
+# Read daily files for each stash and write one monthly file per stash -----------------------
+def write_monthly_files(all_daily_files, stash_save, var_save, campaign_history, outdir, additional_outdir,
+                        runid, cycle_date, method, precision, significant_digits, drop_masked):
+    import os
+    import shutil
+
+    # Only rewrite monthly files if reduced precision or compact output is requested
+    compact = precision != 'float64' or significant_digits != None or drop_masked
+    if compact:
+        from compact_output import compact_netcdf
+
+    cmip6_filename=None
+    for nv in range(len(stash_save)):
+        # Define and read daily files
+        daily_files=[file for file in all_daily_files if '_stash' + stash_save[nv] in file]
+        try:
+            monthly_data=cis.read_data_list(daily_files,[var_save[nv],'campaign'])
+        except BaseException as err:
+            # If file does not exists or problems reading it: 
+            print("Error: {0}".format(err))
+            raise Exception
+        else:
+            # Add campaign data to history (after tidying up string)
+            campaign_string=str(list(dict.fromkeys(campaign_history))) # remove duplicates
+            campaign_string=campaign_string.replace('"', "") # remove unwanted characters
+            campaign_string=campaign_string.replace('{', "")
+            campaign_string=campaign_string.replace('}', "")
+            campaign_string=campaign_string.replace("'", "")
+            monthly_data[1].add_history(campaign_string)
+            # Calculate date for 1 month after cycle date
+            next_month = (datetime.strptime(cycle_date, "%Y%m") + relativedelta(months=1)).strftime("%Y%m")
+            # Filename follows CMIP6 naming convention
+            cmip6_filename= 'atmos_' + runid + 'a_1h_' + cycle_date + '01-' + next_month + '01_' + method +'_stash'+stash_save[nv] + '.nc'
+            monthly_outfile=outdir + cmip6_filename 
+            print(nv, 'Writing data to ', monthly_outfile)
+            monthly_data.save_data(monthly_outfile)
+            if compact:
+                compact_netcdf(monthly_outfile, var_save[nv], precision, significant_digits, drop_masked)
+            if additional_outdir != None:
+                # Running within UM suite: save monthly files to additional directory if one is specified 
+                if not os.path.exists(additional_outdir):
+                    try:
+                        # Create one if it doesn't exist
+                        os.mkdir(additional_outdir)
+                    except BaseException as err:
+                        # If directory cannot be written:
+                        print("Error: {0}".format(err))
+                        raise Exception
+                # Define filenames
+                additional_monthly_outfile=additional_outdir + cmip6_filename
+                print('Also writing data to ', additional_monthly_outfile)
+                # Copy the file already written (and compacted if requested) rather than writing it again
+                shutil.copy(monthly_outfile, additional_monthly_outfile)
+
+    return cmip6_filename
+
+# Write one work unit per day and stash to the shared work queue (sharded coordinator) -------
+def queue_work_units(queue_dir, inputdir, runid, ppstream, cycle_date, read_dates, flight_dates, select_stash):
+    import os
+    from work_queue import init_queue, add_unit
+
+    init_queue(queue_dir)
+    n_units=0
+    input_files=sorted(os.listdir(inputdir))
+    for dd in range(len(read_dates)):
+        m_date=read_dates[dd]
+        f_date=flight_dates[dd]
+
+        # Test if model data exists for specified date
+        test_file=[filename for filename in input_files if (runid in filename and m_date in filename and "a.p" + ppstream in filename)]
+        if len(test_file) == 0:
+            print('Model data for ',m_date,' does not exist. Skipping this date')
+            continue
+
+        # Heaviside functions are read by the workers together with the stash that needs them
+        if select_stash != None:
+            # Stash code (section * 1000 + item) to UM stash source, e.g. 4 -> m01s00i004
+            sources=['m01s' + str(int(name) // 1000).zfill(2) + 'i' + str(int(name) % 1000).zfill(3) for name in select_stash]
+            sources=[source for source in sources if source != 'm01s51i999' and source != 'm01s30i301']
+        else:
+            infile=inputdir+runid+'a.p'+ppstream+m_date+'*'
+            sources=[var.get_property('um_stash_source') for var in cf.read(infile) if not is_heaviside(var)]
+
+        for source in sources:
+            stash=source[4:6] + source[7:10]
+            unit_id=cycle_date + '_' + m_date + '_' + f_date + '_' + stash
+            unit={'cycle_date': cycle_date, 'm_date': m_date, 'f_date': f_date, 'stash': stash, 'um_stash_source': source}
+            if add_unit(queue_dir, unit_id, unit):
+                n_units += 1
+
+    print('Queued ', n_units, ' work units for ', cycle_date)
+
+# Claim work units from the shared work queue and collocate them (sharded worker) ------------
+def process_work_units(queue_dir, inputdir, trackdir, daily_dir, runid, ppstream, cycle_date, method,
+                       multi_year, time_window, backend, lock_timeout):
+    import traceback
+    from work_queue import init_queue, claim_unit, keep_lease, complete_unit, fail_unit, release_unit
+
+    init_queue(queue_dir)
+    n_units=0
+    n_failed=0
+    while True:
+        claimed=claim_unit(queue_dir, cycle_date + '_', lock_timeout)
+        if claimed == None:
+            break
+        unit_id, unit = claimed
+        print('Claimed work unit ', unit_id)
+        # Touch the lock while the unit is processed so that other workers do not reclaim it
+        lease=keep_lease(queue_dir, unit_id, lock_timeout / 4.)
+
+        try:
+            flight, new_time_units, campaigns = read_flight_track(trackdir, unit['f_date'], unit['m_date'], multi_year)
+            infile=inputdir+runid+'a.p'+ppstream+unit['m_date']+'*'
+            reading_vars, heaviside_51, heaviside_30 = read_model_data(infile, None, unit['um_stash_source'])
+            var_name=None
+            for var in reading_vars:
+                if not is_heaviside(var):
+                    var_name=collocate_stash(var, heaviside_51, heaviside_30, flight, method, new_time_units, time_window, backend)
+                    # Flight date is part of the filename as several flights can map onto the same model day
+                    outfile=daily_dir + runid + '_' + unit['m_date'] + '_' + unit['f_date'] + '_stash' + unit['stash'] + '_flight_track.nc'
+                    flight.save_data(outfile)
+            if var_name == None:
+                raise Exception('No field with stash ' + unit['um_stash_source'] + ' in ' + infile)
+        except Exception as err:
+            # Record the failure and move on, so that other workers do not stop on the same unit
+            print("Error: {0}".format(err))
+            lease.set()
+            fail_unit(queue_dir, unit_id, traceback.format_exc())
+            n_failed += 1
+            continue
+        except BaseException:
+            # Interrupted: make the unit available to other workers again before giving up
+            lease.set()
+            release_unit(queue_dir, unit_id)
+            raise
+
+        lease.set()
+        complete_unit(queue_dir, unit_id, {'var_name': var_name, 'campaigns': str(campaigns)})
+        n_units += 1
+
+    print('Processed ', n_units, ' work units for ', cycle_date, ' (', n_failed, ' failed)')
+
 # Function to read, colocate, write output and remove files if required (this works one month at a time) ---------------------------------------
 def process_data_monthly(args,datetag):
     ######
@@ -136,6 +536,15 @@ def process_data_monthly(args,datetag):
     climatology = args.climatology
     outdir = args.outdir
     jobtype = args.jobtype
+    time_window = args.time_window
+    backend = args.backend
+    precision = args.precision
+    significant_digits = args.significant_digits
+    shard = args.shard
+    queue_dir = args.queue_dir
+    lock_timeout = args.lock_timeout
+    select_stash = None
+    additional_outdir = None
 
     # Process parsed arguments and print input variables 
     print(' ')
@@ -157,6 +566,27 @@ def process_data_monthly(args,datetag):
 
     print('Interpolation method = ' + method)
 
+    print('Collocation backend = ' + backend)
+    if backend == 'kdtree' and method != 'nn':
+        raise Exception('The kdtree collocation backend only supports nearest neighbour interpolation (-m nn)')
+
+    if time_window > 0:
+        print('Hourly fields are collocated in windows of ' + str(time_window) + ' time steps')
+
+    if shard != None:
+        if queue_dir == None:
+            raise Exception('A shared work queue directory (--queue_dir) is required for sharded execution')
+        print('Sharded execution: running as ' + shard + ' with work queue in ' + queue_dir)
+
+    if args.drop_masked == 'True' or args.drop_masked == 'true' or args.drop_masked == 'TRUE' or args.drop_masked == 'T':
+        drop_masked=True
+    else:
+        drop_masked=False
+
+    if precision != 'float64' or significant_digits != None or drop_masked:
+        print('Monthly output precision = ' + precision + ', significant digits = ' + str(significant_digits)
+              + ', drop masked points = ' + str(drop_masked))
+
     if climatology == 'True' or climatology == 'true' or climatology == 'TRUE' or climatology == 'T':
         multi_year=True
     else:
@@ -164,7 +594,6 @@ def process_data_monthly(args,datetag):
 
     if jobtype == 'batch':
         print('This script is running within a UM suite')
-        offline=False
         archive_hourly = args.archive_hourly
 
         # Handling of outdir and additional_outdir (specific to batch jobs)
@@ -191,7 +620,6 @@ def process_data_monthly(args,datetag):
 
     elif jobtype == 'postprocessing':
         print('This script is running offline using hourly pp files')
-        offline=True
 
         # Handling of outdir (specific to postprocessing)
         if 'outdir' not in locals():
@@ -220,196 +648,122 @@ def process_data_monthly(args,datetag):
     first=True 
 
     # Find out days within UM cycle for which file track data exists (so we only read and process UM output for those days)
-    files=sorted(os.listdir(trackdir))
-    if multi_year == True:
-        # Find date location in filenames
-        filename0=files[0]
-        date0="".join([n for n in filename0 if n.isdigit()])
-        date_start = filename0.index(date0)
-        # Select dates to read flight data (with same month as cycle date)
-        flight_files=[filename for filename in files if filename[date_start + 4 : date_start + 6] == cycle_date[4:6]]
-        # Select dates with same month and day as flight dates (this will produce output for multiple years for each flight)  
-        read_dates = [cycle_date[0:4] + filename[date_start + 4 : date_start + 8] for filename in flight_files]
-        flight_dates= [filename[date_start : date_start + 8] for filename in flight_files]
-    else:
-        # Select dates with same year, month and date as flight dates
-        flight_files=[filename for filename in files if cycle_date in filename]
-        read_dates=[filename[filename.index(cycle_date):filename.index(cycle_date)+8] for filename in flight_files]
-        flight_dates=read_dates
-
-    # Check Daily subdirectory and prepare appropriately
-    daily_dir = outdir + 'Daily/'
-    if not os.path.exists(daily_dir):
-        # Create one if it doesn't exist
-        os.makedirs(daily_dir)
+    read_dates, flight_dates = find_track_dates(trackdir, cycle_date, multi_year)
+
+    if shard == None:
+        # Check Daily subdirectory and prepare appropriately
+        daily_dir = outdir + 'Daily/'
+        if not os.path.exists(daily_dir):
+            # Create one if it doesn't exist
+            os.makedirs(daily_dir)
+        else:
+            # Remove existing files (this works if there are existing files and does nothing if there are no files)
+            all_files=os.listdir(daily_dir)
+            for dfile in all_files:
+                os.remove(daily_dir + dfile)
     else:
-        # Remove existing files (this works if there are existing files and does nothing if there are no files)
-        all_files=os.listdir(daily_dir)
-        for dfile in all_files:
-            os.remove(daily_dir + dfile)
+        # Daily files of a sharded run are kept per month so that workers never clear each other's output
+        daily_dir = outdir + 'Daily_' + cycle_date + '/'
+        os.makedirs(daily_dir, exist_ok=True)
     ######################################
 
-    ###  TIME LOOP #######
-    for dd in range(len(read_dates)):
-        # Loop through all selected dates
-        m_date=read_dates[dd]
-        f_date=flight_dates[dd]
+    if shard == 'coordinator':
+        # Only write the work units for this month, workers do the processing
+        queue_work_units(queue_dir, inputdir, runid, ppstream, cycle_date, read_dates, flight_dates, select_stash)
+        return True
+
+    elif shard == 'worker':
+        # Process work units for this month until there are none left, the merge step writes monthly files
+        process_work_units(queue_dir, inputdir, trackdir, daily_dir, runid, ppstream, cycle_date, method,
+                           multi_year, time_window, backend, lock_timeout)
+        return True
+
+    elif shard == 'merge':
+        # Only write monthly files once all work units for this month are done
+        from work_queue import init_queue, queue_status
+        init_queue(queue_dir)
+        pending, stale, done, failed = queue_status(queue_dir, cycle_date + '_', lock_timeout)
+        for unit_id in sorted(failed):
+            print('Work unit ', unit_id, ' failed on ', failed[unit_id]['host'], ':')
+            print(failed[unit_id]['error'])
+        for unit_id in sorted(stale):
+            print('Work unit ', unit_id, ' has a stale lock held by ', stale[unit_id], ' (it will be reclaimed by the next worker)')
+        if len(pending) > 0 or len(failed) > 0:
+            print(len(pending), ' work units for ', cycle_date, ' are not done yet and ', len(failed),
+                  ' failed. Not writing monthly files')
+            return False
+        var_save=sorted(set([result['var_name'] for result in done.values() if result['var_name'] != None]))
+        stash_save=[var_name[4:6] + var_name[7:10] for var_name in var_save]
+        campaign_history=[done[unit_id]['campaigns'] for unit_id in sorted(done)]
 
-        # Test if model data exists for specified date
-        input_files=sorted(os.listdir(inputdir))
-        test_file=[filename for filename in input_files if (runid in filename and m_date in filename and "a.p" + ppstream in filename)]
-        if len(test_file) == 0:
-            # Do not read or process data if flight data exists but model data does not.
-            print('Model data for ',m_date,' does not exist. Skipping this date')
-            if first:
-                first_date=read_dates[dd+1]
-        else:
-            #############~~~~~~~~~~~~~~~~~~~~~
-            #   1. READ FLIGHT TRACK DATA
-            #MRR add one line below
-            first_date=read_dates[0]
-            first=False
-            # Define flight track filename for dates within the current UM cycle
-            trackfile=trackdir + '*' + f_date +'*.nc'
-            print('Reading ', trackfile)
-            try:
-                flight=cis.read_data_list(trackfile,['air_pressure','campaign'])
-            except OSError as err:
-                # If file does not exists or problems reading it: 
-                print("Error: {0}".format(err))
-                raise Exception
-            else:    
-                if multi_year == True:
-                    # Convert time to start of flight month 
-                    start_of_flight_month="days since "+f_date[0:4]+"-"+f_date[4:6]+"-01"
-                    new_time_units_1 = cf_units.Unit(start_of_flight_month, calendar=flight[0].coord("time").units.calendar)
-                    flight[0].coord("time").convert_units(new_time_units_1)
-                    # Save time array
-                    saved_time_data=copy.deepcopy(flight[0].coord("time").data)
-                    # Now convert time to start of model month
-                    start_of_model_month="days since "+m_date[0:4]+"-"+m_date[4:6]+"-01"
-                    new_time_units_2 = cf_units.Unit(start_of_model_month, calendar=flight[0].coord("time").units.calendar)
-                    flight[0].coord("time").convert_units(new_time_units_2)
-                    # Replace time array with previously saved time array
-                    flight[0].coord("time").data=saved_time_data
-
-                # Convert CIS time units to common starting point
-                new_time_units = cf_units.Unit("days since 1900-01-01", calendar=flight[0].coord("time").units.calendar)
-                flight.coord("time").convert_units(new_time_units)
-
-                # Convert campaigns name to 8 digit integer (campaign code) and write into history metadata)
-                c_data = copy.deepcopy(flight[1].data)
-                c_names = list(dict.fromkeys(c_data))  # remove duplicates from list
-                c_codes = [generate_campaign_code(name) for name in c_names]
-                campaigns=dict(zip(c_names, c_codes))
-                # convert campaign names to campaign codes and list to numpy array
-                flight[1].data=np.array([campaigns[data] for data in c_data])
+    else:
+        ###  TIME LOOP #######
+        for dd in range(len(read_dates)):
+            # Loop through all selected dates
+            m_date=read_dates[dd]
+            f_date=flight_dates[dd]
+
+            # Test if model data exists for specified date
+            input_files=sorted(os.listdir(inputdir))
+            test_file=[filename for filename in input_files if (runid in filename and m_date in filename and "a.p" + ppstream in filename)]
+            if len(test_file) == 0:
+                # Do not read or process data if flight data exists but model data does not.
+                print('Model data for ',m_date,' does not exist. Skipping this date')
+                if first:
+                    first_date=read_dates[dd+1]
+            else:
+                #############~~~~~~~~~~~~~~~~~~~~~
+                #   1. READ FLIGHT TRACK DATA
+                #MRR add one line below
+                first_date=read_dates[0]
+                first=False
+                flight, new_time_units, campaigns = read_flight_track(trackdir, f_date, m_date, multi_year)
                 # Save campaign information to add to monthly files later
                 campaign_history.append(str(campaigns))
-            #############~~~~~~~~~~~~~~~~~~~~~
-
-            #############=====================
-            #   2. READ MODEL DATA
-            # Specify UM model output so only hourly fields that we want to colocate go into selected pp files
-
-            # Define input filename 
-            infile=inputdir+runid+'a.p'+ppstream+m_date+'*'
-            print('Reading', infile)
-            if 'select_stash' in locals():
-                # Read only selected variables (this produces a cf.Fieldlist)
-
-                try:
-                    reading_vars=cf.read(infile,select=['stash_code='+name for name in select_stash])
-                except OSError as err:
-                    print("Error: {0}".format(err))
-                    raise Exception
-                else:
-                    read_h51=['true' for name in select_stash if name[0:2] == '51' or name[0:2] == '52']
-                    read_h30=['true' for name in select_stash if name[0:2] == '30']
-                    # Read Heaviside step functions
-                    if len(read_h51) >= 1:
-                        heaviside_51=cf.read(infile,select='stash_code=51999')[0] #cf.field.Field
-                    if len(read_h30) >= 1:
-                        heaviside_30=cf.read(infile,select='stash_code=30301')[0] #cf.field.Field
-            else:
-                # Reading all variables in the pp stream (this produces a cf.Fieldlist)
-                try:
-                    reading_vars=cf.read(infile)
-                except OSError as err:
-                    # If file does not exists or problems reading it:
-                    print("Error: {0}".format(err))
-                    raise Exception
-                else:
-                    # Extract Heaviside step functions from reading_vars (if heaviside is not there will return an empty list)
-                    heaviside_51 = [var for var in reading_vars if var.get_property("um_stash_source") == "m01s51i999"][0]
-                    heaviside_30 = [var for var in reading_vars if var.get_property("um_stash_source") == "m01s30i301"][0]
-            #############=====================
-
-            #############+++++++++++++++++++++
-            #   3. PROCESS AND COLOCATE (ONE STASHCODE AT THE TIME)
-
-            ###  VARIABLES LOOP ####
-            for var in reading_vars:
-                # Loop through all stashcode fields in daily variable
-                print('Reading ',var.get_property("um_stash_source"))
-
-                # Check if field is a Heaviside function and only process field if not heaviside
-                if (var.get_property("um_stash_source") != "m01s51i999" and var.get_property("um_stash_source") != "m01s30i301"):
-                    print('Processing ',var.get_property("um_stash_source"))
-
-                    # For section 51 and 52
-                    if var.get_property('um_stash_source')[0:6] == 'm01s51' or var.get_property('um_stash_source')[0:6] == 'm01s52':
-                        # Check that the appropriate Heaviside function has been read
-                        if 'heaviside_51' in locals():
-                            print('Dividing field by Heaviside step function')
-                            var = var/heaviside_51
-                        else:
-                            raise Exception('Heaviside function is required for section 51 or 52: add 51999 to UM output')
-
-                    # For section 30
-                    if var.get_property('um_stash_source')[0:6] == 'm01s30':
-                    # Check that the appropriate Heaviside function has been read
-                        if 'heaviside_30' in locals():
-                            print('Dividing field by Heaviside step function')
-                            var = var/heaviside_30
-                        else:
-                            raise Exception('Heaviside function is required for section 30: add 30301 to output')
-
-                    # Move data to cis variable format (cf.field.Field to cis.data_io.gridded_data.GriddedData)
-                    try:
-                        cisvar=cis_from_cf(var)
-                    except BaseException as err:
-                        # If file does not exists or problems reading it: 
-                        print("Error: {0}".format(err))
-                        raise Exception
-                
-                    # Convert working_var_cis to same time units as flight data
-                    cisvar.coord("time").convert_units(new_time_units)
-                    # Collocate
-                    trackvar=cisvar.collocated_onto(flight[0], how=method)   #cis.data_io.ungridded_data.UngriddedDataList
-                    flight[0]=trackvar[0]
-                    #############+++++++++++++++++++++
-
-                    #############---------------------
-                    #   4. WRITE TEMPORARY DAILY OUTPUT
-                    # Output files: one file per day for each variable
-                    # Define stashcodes for writing monthly files later
-                    stash=cisvar.var_name[4:6] + cisvar.var_name[7:10]
-                    if m_date == first_date: #read_dates[0]:
-                        stash_save.append(stash)
-                        var_save.append(cisvar.var_name)
-
-                    # Define output filename for daily files
-                    outfile=daily_dir + runid + '_' + m_date + '_stash' + stash + '_flight_track.nc' # one file per day
-
-                    try:
-                        flight.save_data(outfile)
-                    except BaseException as err:
-                        # If file cannot be written: 
-                        print("Error: {0}".format(err))
-                        raise Exception
-
-                    #############---------------------
+                #############~~~~~~~~~~~~~~~~~~~~~
+
+                #############=====================
+                #   2. READ MODEL DATA
+                # Specify UM model output so only hourly fields that we want to colocate go into selected pp files
+
+                # Define input filename 
+                infile=inputdir+runid+'a.p'+ppstream+m_date+'*'
+                reading_vars, heaviside_51, heaviside_30 = read_model_data(infile, select_stash)
+                #############=====================
+
+                #############+++++++++++++++++++++
+                #   3. PROCESS AND COLOCATE (ONE STASHCODE AT THE TIME)
+
+                ###  VARIABLES LOOP ####
+                for var in reading_vars:
+                    # Loop through all stashcode fields in daily variable
+                    print('Reading ',var.get_property("um_stash_source"))
+
+                    # Check if field is a Heaviside function and only process field if not heaviside
+                    if not is_heaviside(var):
+                        var_name=collocate_stash(var, heaviside_51, heaviside_30, flight, method, new_time_units, time_window, backend)
+                        #############+++++++++++++++++++++
+
+                        #############---------------------
+                        #   4. WRITE TEMPORARY DAILY OUTPUT
+                        # Output files: one file per day for each variable
+                        # Define stashcodes for writing monthly files later
+                        stash=var_name[4:6] + var_name[7:10]
+                        if m_date == first_date: #read_dates[0]:
+                            stash_save.append(stash)
+                            var_save.append(var_name)
+
+                        # Define output filename for daily files
+                        outfile=daily_dir + runid + '_' + m_date + '_stash' + stash + '_flight_track.nc' # one file per day
+
+                        try:
+                            flight.save_data(outfile)
+                        except BaseException as err:
+                            # If file cannot be written: 
+                            print("Error: {0}".format(err))
+                            raise Exception
+
+                        #############---------------------
 
     #############@@@@@@@@@@@@@@@@@@@@@
     #   5. WRITE MONTHLY OUTPUT
@@ -421,45 +775,9 @@ def process_data_monthly(args,datetag):
     all_daily_files=[daily_dir + file for file in all_daily_files]
     if len(all_daily_files) > 0:
         # Read daily files for each stash and write monthly file (one monthly file per stashcode)
-        for nv in range(len(stash_save)):
-            # Define and read daily files
-            daily_files=[file for file in all_daily_files if stash_save[nv] in file]
-            try:
-                monthly_data=cis.read_data_list(daily_files,[var_save[nv],'campaign'])
-            except BaseException as err:
-                # If file does not exists or problems reading it: 
-                print("Error: {0}".format(err))
-                raise Exception
-            else:
-                # Add campaign data to history (after tidying up string)
-                campaign_string=str(list(dict.fromkeys(campaign_history))) # remove duplicates
-                campaign_string=campaign_string.replace('"', "") # remove unwanted characters
-                campaign_string=campaign_string.replace('{', "")
-                campaign_string=campaign_string.replace('}', "")
-                campaign_string=campaign_string.replace("'", "")
-                monthly_data[1].add_history(campaign_string)
-                # Calculate date for 1 month after cycle date
-                next_month = (datetime.strptime(cycle_date, "%Y%m") + relativedelta(months=1)).strftime("%Y%m")
-                # Filename follows CMIP6 naming convention
-                cmip6_filename= 'atmos_' + runid + 'a_1h_' + cycle_date + '01-' + next_month + '01_' + method +'_stash'+stash_save[nv] + '.nc'
-                monthly_outfile=outdir + cmip6_filename 
-                print(nv, 'Writing data to ', monthly_outfile)
-                monthly_data.save_data(monthly_outfile)
-                if not offline:
-                    # Running within UM suite: save monthly files to additional directory if one is specified 
-                    if 'additional_outdir' in locals() :
-                        if not os.path.exists(additional_outdir):
-                            try:
-                                # Create one if it doesn't exist
-                                os.mkdir(additional_outdir)
-                            except BaseException as err:
-                                # If directory cannot be written:
-                                print("Error: {0}".format(err))
-                                raise Exception
-                        # Define filenames
-                        additional_monthly_outfile=additional_outdir + cmip6_filename
-                        print('Also writing data to ', additional_monthly_outfile)
-                        monthly_data.save_data(additional_monthly_outfile)
+        cmip6_filename=write_monthly_files(all_daily_files, stash_save, var_save, campaign_history, outdir,
+                                           additional_outdir, runid, cycle_date, method,
+                                           precision, significant_digits, drop_masked)
 
         # Check if monthly_outfile exists and delete Daily output on flight track
         monthly_files=(os.listdir(outdir))
@@ -494,6 +812,8 @@ def process_data_monthly(args,datetag):
                 print("Error: {0}".format(err))
     else:
         print('Keeping hourly ppstream')
+
+    return True
 #############*********************
 
 # End of functions
@@ -501,44 +821,72 @@ def process_data_monthly(args,datetag):
 
 
 ######## MAIN PROGRAMM ############
-# Argument handling --------------
-# Create the parser
-parser=argparse.ArgumentParser()
-parser.add_argument('-i','--inputdir',required=True,type=str,help='Input directory containing hourly pp files')
-parser.add_argument('-t','--trackdir',required=True,type=str,help='Directory with input files to colocate onto')
-parser.add_argument('-d','--cycle_date',required=True,type=str,help='Date tag to identify start period for analysis')
-parser.add_argument('-n','--n_months',default=1,type=int,help='Number of months to process')
-parser.add_argument('-r','--runid',required=True,type=str,help='UM job id')
-parser.add_argument('-p','--ppstream',required=True,type=str,help='ppstream containing hourly data')
-parser.add_argument('-m','--method',type=str,choices=['lin','nn'],default='lin',
-        help='Interpolation method, choose between linear and nearest neighbour')
-parser.add_argument('-c','--climatology',type=str,default='False',
-        help='Model calendar, choose between 360_day and gregorian')
-parser.add_argument('-o','--outdir',type=str,help='Output directory for model output on flight track')
-
-# Create subparsers for jobtype
-subparser = parser.add_subparsers(dest='jobtype')
-# Add subparsers
-batch=subparser.add_parser('batch')
-postproc=subparser.add_parser('postprocessing')
-# Add conditional arguments for batch job
-batch.add_argument('-a','--archive_hourly',type=str,default='True',help='logical to archive hourly UM fieldfiles')
-# Add conditional arguments for postprocessing job
-postproc.add_argument('-s','--select_stash',type=str,nargs='+',help='Optional: only process selected stashcodes')
-
-# Parse the arguments
-args=parser.parse_args()
-
-# Identify start date and number of months to process
-start_date=args.cycle_date
-n_months=args.n_months
-
-# Loop through months to process (default is one)
-for nm in range(n_months):
-    # Calculate date tag (YEARMONTH) for month to be processed
-    datetag=(datetime.strptime(start_date, "%Y%m") + relativedelta(months=nm)).strftime("%Y%m")
-    # Call function to process UM data for specified month
-    process_data_monthly(args,datetag)
+if __name__ == '__main__':
+    # Argument handling --------------
+    # Create the parser
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-i','--inputdir',required=True,type=str,help='Input directory containing hourly pp files')
+    parser.add_argument('-t','--trackdir',required=True,type=str,help='Directory with input files to colocate onto')
+    parser.add_argument('-d','--cycle_date',required=True,type=str,help='Date tag to identify start period for analysis')
+    parser.add_argument('-n','--n_months',default=1,type=int,help='Number of months to process')
+    parser.add_argument('-r','--runid',required=True,type=str,help='UM job id')
+    parser.add_argument('-p','--ppstream',required=True,type=str,help='ppstream containing hourly data')
+    parser.add_argument('-m','--method',type=str,choices=['lin','nn'],default='lin',
+            help='Interpolation method, choose between linear and nearest neighbour')
+    parser.add_argument('-b','--backend',type=str,choices=['cis','kdtree'],default='cis',
+            help='Collocation backend: cis or spatial index (kdtree, nearest neighbour only, supports rotated and limited area grids)')
+    parser.add_argument('-c','--climatology',type=str,default='False',
+            help='Model calendar, choose between 360_day and gregorian')
+    parser.add_argument('--precision',type=str,choices=['float64','float32','int16'],default='float64',
+            help='Optional: precision of collocated variables in monthly files (int16 is packed with scale_factor and add_offset)')
+    parser.add_argument('--significant_digits',type=int,
+            help='Optional: quantise collocated variables in monthly files to this number of significant digits')
+    parser.add_argument('--drop_masked',type=str,default='False',
+            help='Optional: drop flight points where the model variable is masked from monthly files')
+    parser.add_argument('-o','--outdir',type=str,help='Output directory for model output on flight track')
+    parser.add_argument('--shard',type=str,choices=['coordinator','worker','merge'],
+            help='Optional: sharded execution through a shared work queue (coordinator queues work, workers collocate, merge writes monthly files)')
+    parser.add_argument('--queue_dir',type=str,help='Shared directory holding the work queue for sharded execution')
+    parser.add_argument('--lock_timeout',type=float,default=600.,
+            help='Seconds after which the lock of a work unit that is no longer touched by its worker is stale and can be reclaimed')
+    parser.add_argument('-w','--time_window',type=int,default=0,
+            help='Optional: number of hourly time steps read per collocation window (e.g. 2 for pairs of adjacent hours); 0 reads the full day')
+
+    # Create subparsers for jobtype
+    subparser = parser.add_subparsers(dest='jobtype')
+    # Add subparsers
+    batch=subparser.add_parser('batch')
+    postproc=subparser.add_parser('postprocessing')
+    # Add conditional arguments for batch job
+    batch.add_argument('-a','--archive_hourly',type=str,default='True',help='logical to archive hourly UM fieldfiles')
+    # Add conditional arguments for postprocessing job
+    postproc.add_argument('-s','--select_stash',type=str,nargs='+',help='Optional: only process selected stashcodes')
+
+    # Parse the arguments
+    args=parser.parse_args()
+    # Windows of one time step cannot be used for interpolation in time (0 reads the full day)
+    if args.time_window != 0 and args.time_window < 2:
+        parser.error('--time_window must be 0 (full day) or at least 2 time steps')
+    if args.significant_digits != None and args.significant_digits < 1:
+        parser.error('--significant_digits must be at least 1')
+
+    # Identify start date and number of months to process
+    start_date=args.cycle_date
+    n_months=args.n_months
+
+    # Loop through months to process (default is one)
+    incomplete=[]
+    for nm in range(n_months):
+        # Calculate date tag (YEARMONTH) for month to be processed
+        datetag=(datetime.strptime(start_date, "%Y%m") + relativedelta(months=nm)).strftime("%Y%m")
+        # Call function to process UM data for specified month
+        if process_data_monthly(args,datetag) == False:
+            incomplete.append(datetag)
+
+    # Sharded merge: exit with an error if some months could not be merged (so batch pipelines can detect it)
+    if len(incomplete) > 0:
+        print('Monthly files not written for: ', incomplete)
+        sys.exit(1)
 
 ##### END MAIN ####################
 
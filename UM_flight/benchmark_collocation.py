@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#######################################################################################
+# Regression harness for the collocation backends of UM_to_flightrack.py
+# the script will perform the following steps:
+#     1) create synthetic model and flight track data, or read recorded UM and flight track files
+#     2) collocate every model variable with every available backend and method (lin/nn)
+#     3) compare each backend with the cis reference (full day, same method) within tolerances
+#        and measure throughput (points/s, variables/s) and peak memory
+#     4) append the results to a json history file and compare speed with the median of the last earlier runs
+#        that passed on the same input, host and number of repetitions
+#     5) exit with an error if a backend fails, accuracy drifts or speed regresses beyond the thresholds
+#
+# Backends: 'cis' (reference, full day at once), 'cis_windowed' (pairs of adjacent hours,
+# see --time_window in UM_to_flightrack.py) and 'kdtree' (spatial index, nearest neighbour only)
+#
+# How to call the script on the command line:
+# python3 benchmark_collocation.py synthetic -g 'n_lat' 'n_lon' -l 'n_levels' -n 'n_points' -o 'history_file'
+# python3 benchmark_collocation.py recorded -i 'model_file' -t 'trackdir' -d 'YYYYMMDD' -s 'select_stash' -o 'history_file'
+# where:
+# 'n_lat' 'n_lon' = size of the synthetic global grid (optional; default=145 192, N96)
+# 'n_levels' = number of synthetic pressure levels (optional; default=17)
+# 'n_points' = number of synthetic flight track points (optional; default=28800, 8 hours at 1 Hz)
+# 'model_file' = UM hourly pp or fieldsfile(s) for one day (wildcards allowed)
+# 'trackdir' and 'YYYYMMDD' = directory and date of the flight track file
+# 'select_stash' = stash codes of variables to use (optional, default = all variables in model file)
+# 'history_file' = json file the results are appended to (optional; default=collocation_benchmark.json)
+# Tolerances: --rtol, --atol (accuracy per point), --max_mismatch (fraction of points allowed to differ,
+# including points masked by only one of the two backends) and --max_slowdown (fraction of the median
+# throughput of the last --baseline_runs passing runs that may be lost before the run fails)
+# A backend that raises an error fails the run, unless --allow_backend_errors is given (errors of the cis
+# reference always fail the run)
+# Peak memory is measured in a separate run after the timed runs, with the kdtree spatial index cache
+# cleared so that building the index is included
+#######################################################################################
+
+from datetime import datetime
+import numpy as np
+import argparse
+import cf
+import cis
+import cf_units
+import json
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+from UM_to_flightrack import (collocate_cfvar, collocate_in_time_windows, read_flight_track, read_model_data,
+                              is_heaviside, apply_heaviside)
+import kdtree_collocation
+from kdtree_collocation import collocate_kdtree
+
+#########################################################################################################
+# Required functions below
+
+# Create a synthetic cf field on a regular global grid with pressure levels and hourly times ----------
+def synthetic_field(n_lat, n_lon, n_levels, n_times=24):
+    lat=np.linspace(-90., 90., n_lat)
+    lon=np.linspace(0., 360., n_lon, endpoint=False)
+    pressure=np.linspace(1000., 100., n_levels)
+    times=np.arange(n_times) / 24.
+
+    # Smooth field varying along all axes
+    t4, p4, lat4, lon4 = np.meshgrid(times, pressure, lat, lon, indexing='ij')
+    data=(250. + 30. * np.cos(np.deg2rad(lat4)) + 5. * np.sin(np.deg2rad(lon4)) * np.cos(2. * np.pi * t4)
+          + 0.02 * p4)
+
+    field=cf.Field(properties={'standard_name': 'air_temperature', 'units': 'K', 'um_stash_source': 'm01s30i204'})
+    axes=[]
+    # Dimension coordinates are set in the same order as the data axes (cis_from_cf relies on this)
+    for name, units, points in [('time', 'days since 1900-01-01', times), ('air_pressure', 'hPa', pressure),
+                                ('latitude', 'degrees_north', lat), ('longitude', 'degrees_east', lon)]:
+        axis=field.set_construct(cf.DomainAxis(len(points)))
+        coord=cf.DimensionCoordinate(properties={'standard_name': name, 'units': units}, data=cf.Data(points))
+        field.set_construct(coord, axes=axis)
+        axes.append(axis)
+    field.set_data(cf.Data(data), axes=axes)
+
+    return field
+
+# Create a synthetic flight track (cis ungridded data) within the synthetic model day --------------------
+def synthetic_track(n_points, seed=0):
+    from cis.data_io.ungridded_data import UngriddedData, Metadata
+    from cis.data_io.Coord import Coord, CoordList
+
+    rng=np.random.default_rng(seed)
+    # Random walk at 1 Hz: a few degrees of latitude and longitude, climbing and descending
+    lat=np.clip(50. + np.cumsum(rng.normal(0., 0.002, n_points)), -89., 89.)
+    lon=np.clip(10. + np.cumsum(rng.normal(0.0005, 0.002, n_points)), 0., 350.)
+    pressure=np.clip(600. + 350. * np.sin(np.linspace(0., 3. * np.pi, n_points)), 120., 990.)
+    times=np.linspace(2. / 24., 22. / 24., n_points)
+
+    coords=CoordList([
+        Coord(lat, Metadata(standard_name='latitude', units='degrees_north', shape=lat.shape), axis='y'),
+        Coord(lon, Metadata(standard_name='longitude', units='degrees_east', shape=lon.shape), axis='x'),
+        Coord(pressure, Metadata(standard_name='air_pressure', units='hPa', shape=pressure.shape)),
+        Coord(times, Metadata(standard_name='time', units=cf_units.Unit('days since 1900-01-01', calendar='gregorian'),
+                              shape=times.shape), axis='t')])
+    metadata=Metadata(name='air_pressure', standard_name='air_pressure', units='hPa', shape=pressure.shape)
+
+    return UngriddedData(data=pressure, metadata=metadata, coords=coords)
+
+# Available backends: (name, method, collocation function) --------------------------------------------
+def get_backends():
+    return [('cis', 'lin', lambda var, track, units: collocate_cfvar(var, track, 'lin', units)),
+            ('cis', 'nn', lambda var, track, units: collocate_cfvar(var, track, 'nn', units)),
+            ('cis_windowed', 'lin', lambda var, track, units: collocate_in_time_windows(var, track, 'lin', units, 2)),
+            ('cis_windowed', 'nn', lambda var, track, units: collocate_in_time_windows(var, track, 'nn', units, 2)),
+            ('kdtree', 'nn', lambda var, track, units: collocate_kdtree(var, track, units))]
+
+# Run one backend on all variables and measure time and peak memory -----------------------------------
+def run_backend(function, variables, track, new_time_units, repeat):
+    # Timed runs without memory tracing (tracing slows the backends down)
+    best_time=None
+    for nr in range(repeat):
+        start=time.perf_counter()
+        results=[np.ma.asarray(function(var, track, new_time_units).data) for var in variables]
+        elapsed=time.perf_counter() - start
+        if best_time == None or elapsed < best_time:
+            best_time=elapsed
+
+    # Separate traced run for peak memory only (without the spatial indexes cached by the timed runs)
+    kdtree_collocation._grid_indexes.clear()
+    tracemalloc.start()
+    for var in variables:
+        function(var, track, new_time_units)
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return results, best_time, peak
+
+# Compare collocated values with the reference ------------------------------------------------------
+def compare(results, reference, rtol, atol):
+    n_points=0
+    n_mismatch=0
+    max_abs_diff=0.
+    max_rel_diff=0.
+    for data, ref in zip(results, reference):
+        mask=np.ma.getmaskarray(data)
+        ref_mask=np.ma.getmaskarray(ref)
+        both=~mask & ~ref_mask
+        diff=np.abs(np.ma.getdata(data)[both] - np.ma.getdata(ref)[both])
+        scale=np.abs(np.ma.getdata(ref)[both])
+        n_points += len(mask)
+        n_mismatch += int(np.sum(mask != ref_mask)) + int(np.sum(diff > atol + rtol * scale))
+        if len(diff) > 0:
+            max_abs_diff=max(max_abs_diff, float(np.max(diff)))
+            max_rel_diff=max(max_rel_diff, float(np.max(diff / np.maximum(scale, np.finfo(np.float64).tiny))))
+
+    return max_abs_diff, max_rel_diff, n_mismatch / max(n_points, 1)
+
+# End of functions
+#########################################################################################################
+
+
+######## MAIN PROGRAMM ############
+if __name__ == '__main__':
+    # Argument handling --------------
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-o','--history_file',type=str,default='collocation_benchmark.json',
+            help='json file the benchmark results are appended to')
+    parser.add_argument('--rtol',type=float,default=1e-5,help='Relative tolerance against the cis reference')
+    parser.add_argument('--atol',type=float,default=1e-8,help='Absolute tolerance against the cis reference')
+    parser.add_argument('--max_mismatch',type=float,default=0.01,
+            help='Fraction of points allowed to differ from the cis reference beyond the tolerances')
+    parser.add_argument('--max_slowdown',type=float,default=0.2,
+            help='Fraction of the median throughput of earlier passing runs that can be lost before the run fails')
+    parser.add_argument('--baseline_runs',type=int,default=5,
+            help='Number of the last passing runs (same input, host and repeat) used as speed baseline')
+    parser.add_argument('--allow_backend_errors',action='store_true',
+            help='Report errors of backends other than the cis reference without failing the run')
+    parser.add_argument('--repeat',type=int,default=1,help='Number of timed repetitions (the fastest is kept)')
+
+    # Create subparsers for input type
+    subparser = parser.add_subparsers(dest='inputtype', required=True)
+    synthetic=subparser.add_parser('synthetic')
+    recorded=subparser.add_parser('recorded')
+    synthetic.add_argument('-g','--grid',type=int,nargs=2,default=[145, 192],help='Number of latitudes and longitudes')
+    synthetic.add_argument('-l','--levels',type=int,default=17,help='Number of pressure levels')
+    synthetic.add_argument('-n','--n_points',type=int,default=28800,help='Number of flight track points')
+    recorded.add_argument('-i','--model_file',required=True,type=str,help='UM hourly pp or fieldsfile(s) for one day')
+    recorded.add_argument('-t','--trackdir',required=True,type=str,help='Directory with flight track files')
+    recorded.add_argument('-d','--date',required=True,type=str,help='Date (YYYYMMDD) of the flight track file')
+    recorded.add_argument('-s','--select_stash',type=str,nargs='+',help='Optional: only use selected stashcodes')
+
+    args=parser.parse_args()
+
+    #############~~~~~~~~~~~~~~~~~~~~~
+    #   1. INPUT DATA
+    if args.inputtype == 'synthetic':
+        variables=[synthetic_field(args.grid[0], args.grid[1], args.levels)]
+        track=synthetic_track(args.n_points)
+        new_time_units=cf_units.Unit('days since 1900-01-01', calendar='gregorian')
+        input_label='synthetic_' + str(args.grid[0]) + 'x' + str(args.grid[1]) + 'x' + str(args.levels) + '_' + str(args.n_points)
+    else:
+        trackdir=args.trackdir
+        if trackdir[-1] != '/':
+            trackdir=trackdir+'/'
+        flight, new_time_units, campaigns = read_flight_track(trackdir, args.date, args.date, False)
+        track=flight[0]
+        reading_vars, heaviside_51, heaviside_30 = read_model_data(args.model_file, args.select_stash)
+        variables=[apply_heaviside(var, heaviside_51, heaviside_30) for var in reading_vars if not is_heaviside(var)]
+        input_label=os.path.basename(args.model_file) + '_' + args.date
+    n_points=len(track.data)
+    print('Input = ', input_label, ': ', len(variables), ' variables, ', n_points, ' flight track points')
+    #############~~~~~~~~~~~~~~~~~~~~~
+
+    #############+++++++++++++++++++++
+    #   2. AND 3. COLLOCATE WITH EVERY BACKEND AND COMPARE WITH CIS REFERENCE
+    results={}
+    reference={}
+    for name, method, function in get_backends():
+        label=name + '_' + method
+        if name != 'cis' and method not in reference:
+            results[label]={'error': 'no cis reference for method ' + method}
+            continue
+        print('Running ', label)
+        try:
+            collocated, elapsed, peak = run_backend(function, variables, track, new_time_units, args.repeat)
+        except Exception as err:
+            # A backend that cannot run on this input (e.g. missing coordinates) is reported (and fails the run unless allowed)
+            print("Error: {0}".format(err))
+            results[label]={'error': str(err)}
+            continue
+        if name == 'cis':
+            reference[method]=collocated
+        max_abs_diff, max_rel_diff, mismatch = compare(collocated, reference[method], args.rtol, args.atol)
+        results[label]={'max_abs_diff': max_abs_diff, 'max_rel_diff': max_rel_diff, 'mismatch_fraction': mismatch,
+                        'seconds': elapsed, 'points_per_s': n_points * len(variables) / elapsed,
+                        'variables_per_s': len(variables) / elapsed, 'peak_memory_mb': peak / 1024. ** 2}
+        print(label, results[label])
+    #############+++++++++++++++++++++
+
+    #############---------------------
+    #   4. WRITE HISTORY AND COMPARE WITH BASELINE
+    history=[]
+    if os.path.exists(args.history_file):
+        with open(args.history_file) as f:
+            history=json.load(f)
+    # Baseline: last earlier runs on the same input, host and number of repetitions that passed
+    # (failed runs never become the reference)
+    host=socket.gethostname()
+    previous=[run for run in history if run['input'] == input_label and run.get('host') == host
+              and run.get('repeat') == args.repeat and len(run['failures']) == 0][-args.baseline_runs:]
+
+    failures=[]
+    for label, result in results.items():
+        if 'error' in result:
+            if label == 'cis_lin' or label == 'cis_nn':
+                failures.append(label + ': reference backend failed: ' + result['error'])
+            elif not args.allow_backend_errors:
+                failures.append(label + ': ' + result['error'])
+            continue
+        if result['mismatch_fraction'] > args.max_mismatch:
+            failures.append(label + ': ' + str(result['mismatch_fraction']) + ' of points differ from the cis reference')
+        # Compare with the median throughput of the baseline runs (robust to a single unusually fast or slow run)
+        previous_speeds=[run['results'][label]['points_per_s'] for run in previous
+                         if label in run['results'] and 'points_per_s' in run['results'][label]]
+        if len(previous_speeds) > 0:
+            baseline_speed=float(np.median(previous_speeds))
+            if result['points_per_s'] < (1. - args.max_slowdown) * baseline_speed:
+                failures.append(label + ': ' + str(round(result['points_per_s'])) + ' points/s, baseline '
+                                + str(round(baseline_speed)) + ' points/s')
+
+    history.append({'date': datetime.now().isoformat(timespec='seconds'), 'input': input_label, 'host': host,
+                    'repeat': args.repeat, 'n_points': n_points, 'n_variables': len(variables), 'results': results,
+                    'failures': failures})
+    with open(args.history_file, 'w') as f:
+        json.dump(history, f, indent=1)
+    print('Results appended to ', args.history_file)
+    #############---------------------
+
+    #############@@@@@@@@@@@@@@@@@@@@@
+    #   5. FAIL IF A BACKEND FAILS, ACCURACY DRIFTS OR SPEED REGRESSES
+    if len(failures) > 0:
+        for failure in failures:
+            print('FAILED ', failure)
+        sys.exit(1)
+    print('All backends within tolerances')
+
+##### END MAIN ####################
@@ -0,0 +1,125 @@
+#######################################################################################
+# Reduced precision and compact output for monthly files of model variables collocated
+# onto flight tracks (as written by UM_to_flightrack.py).
+# The collocated variable can be stored as float32 or as int16 packed with scale_factor
+# and add_offset, optionally quantised to a number of significant digits (trailing
+# mantissa bits are rounded to zero so that they compress well), and flight points where
+# the model variable is masked can be dropped. All variables are written with zlib
+# compression. The file is rewritten in place.
+#######################################################################################
+
+def quantise(data, significant_digits):
+    import numpy as np
+
+    # Round the mantissa of floating point data to the number of bits needed for significant_digits
+    if significant_digits < 1:
+        raise Exception('At least one significant digit is required for quantisation')
+    data = np.ma.asarray(data)
+    if data.dtype == np.float32:
+        n_mantissa, uint = 23, np.uint32
+    elif data.dtype == np.float64:
+        n_mantissa, uint = 52, np.uint64
+    else:
+        return data
+    keep_bits = int(np.ceil(significant_digits * np.log2(10)))
+    if keep_bits >= n_mantissa:
+        return data
+
+    drop_bits = n_mantissa - keep_bits
+    bits = np.ascontiguousarray(data.filled(0)).view(uint)
+    half = uint(1 << (drop_bits - 1))
+    keep_mask = ~uint((1 << drop_bits) - 1)
+    rounded = ((bits + half) & keep_mask).view(data.dtype)
+
+    return np.ma.masked_array(rounded, mask=np.ma.getmaskarray(data))
+
+############################################################################################
+
+def pack_int16(data):
+    import numpy as np
+
+    # Pack data into int16 with scale_factor and add_offset (-32768 is kept for missing values)
+    data = np.ma.asarray(data, dtype=np.float64)
+    fill_value = np.int16(-32768)
+    if data.count() == 0:
+        return np.full(data.shape, fill_value, dtype=np.int16), fill_value, 1., 0.
+    vmin = data.min()
+    vmax = data.max()
+    add_offset = (vmax + vmin) / 2.
+    scale_factor = (vmax - vmin) / (2 ** 16 - 2)
+    if scale_factor == 0:
+        scale_factor = 1.
+    packed = np.ma.round((data - add_offset) / scale_factor)
+    packed = np.ma.clip(packed, -32767, 32767).astype(np.int16).filled(fill_value)
+
+    return packed, fill_value, scale_factor, add_offset
+
+############################################################################################
+
+def compact_netcdf(filename, var_name, precision='float64', significant_digits=None, drop_masked=False):
+    import os
+    import numpy as np
+    import netCDF4
+
+    tmpfile = filename + '.compact.tmp'
+    with netCDF4.Dataset(filename, 'r') as src, netCDF4.Dataset(tmpfile, 'w', format='NETCDF4') as dst:
+        src.set_auto_mask(True)
+        data_var = src.variables[var_name]
+        # Dimension of the flight points (variables along it are subset when dropping masked points)
+        point_dim = data_var.dimensions[0]
+        keep = None
+        if drop_masked:
+            keep = ~np.ma.getmaskarray(data_var[:])
+            if not np.any(keep):
+                # A 0-length dimension would become unlimited: keep the (all masked) points instead
+                print('All points of ', var_name, ' are masked: keeping them in ', filename)
+                keep = None
+
+        dst.setncatts({attr: src.getncattr(attr) for attr in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            size = len(dim)
+            if name == point_dim and keep is not None:
+                size = int(np.sum(keep))
+            dst.createDimension(name, None if dim.isunlimited() else size)
+
+        for name, var in src.variables.items():
+            data = var[:]
+            if keep is not None and point_dim in var.dimensions:
+                index = [slice(None)] * var.ndim
+                index[var.dimensions.index(point_dim)] = keep
+                data = data[tuple(index)]
+            attrs = {attr: var.getncattr(attr) for attr in var.ncattrs() if attr != '_FillValue'}
+            fill_value = getattr(var, '_FillValue', None)
+
+            if name == var_name and precision == 'int16':
+                # Scaled integers (quantised first if requested): write packed values directly
+                if significant_digits != None:
+                    data = quantise(np.ma.asarray(data, dtype=np.float64), significant_digits)
+                packed, fill_value, scale_factor, add_offset = pack_int16(data)
+                out = dst.createVariable(name, 'i2', var.dimensions, zlib=True, fill_value=fill_value)
+                out.setncatts(attrs)
+                out.setncatts({'scale_factor': scale_factor, 'add_offset': add_offset, 'missing_value': fill_value})
+                out.set_auto_maskandscale(False)
+                out[:] = packed
+                continue
+
+            dtype = var.dtype
+            if name == var_name:
+                if precision == 'float32':
+                    dtype = np.dtype(np.float32)
+                    data = np.ma.asarray(data).astype(np.float32)
+                if significant_digits != None:
+                    data = quantise(data, significant_digits)
+            if dtype != var.dtype:
+                # Missing values must have the same type as the variable
+                if fill_value is not None:
+                    fill_value = np.array(fill_value).astype(dtype)
+                if 'missing_value' in attrs:
+                    attrs['missing_value'] = np.array(attrs['missing_value']).astype(dtype)
+            out = dst.createVariable(name, dtype, var.dimensions, zlib=(dtype != str), fill_value=fill_value)
+            out.setncatts(attrs)
+            out[:] = data
+
+    os.replace(tmpfile, filename)
+
+############################################################################################
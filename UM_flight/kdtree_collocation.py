@@ -0,0 +1,223 @@
+#######################################################################################
+# Nearest neighbour collocation of cf fields onto flight tracks using a spatial index.
+# The horizontal search uses a cKDTree built on 3-D Cartesian coordinates of the 2-D
+# latitude/longitude of the grid, so it works on regular, rotated pole and limited area
+# UM grids alike (2-D auxiliary coordinates are used when present). The tree is built
+# once per grid and reused for every stash and day.
+# Time and vertical levels are matched to the nearest model value; flight points outside
+# the model time or level range, or outside the bounds of the edge cells of a limited area
+# domain, are masked.
+#######################################################################################
+
+# Spatial indexes already built, keyed by grid (built once per grid and reused)
+_grid_indexes = {}
+
+# Fraction of a grid step allowed beyond the bounds of an edge cell (e.g. the pole for a global grid
+# whose last row is half a step from it)
+_EDGE_TOLERANCE = 1.e-3
+
+############################################################################################
+
+def lonlat_to_xyz(lon, lat):
+    import numpy as np
+
+    # Cartesian coordinates on the unit sphere (so that distances do not depend on longitude wrapping)
+    lon = np.deg2rad(np.asarray(lon, dtype=np.float64))
+    lat = np.deg2rad(np.asarray(lat, dtype=np.float64))
+
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+############################################################################################
+
+def axis_position(cfvar, identity):
+    # Position in the field data of the axis spanned by the dimension coordinate identified by identity (e.g. 'T', 'Z')
+    key = cfvar.dimension_coordinate(identity, key=True, default=None)
+    if key is None:
+        return None
+
+    return cfvar.get_data_axes().index(cfvar.get_data_axes(key)[0])
+
+############################################################################################
+
+def grid_lonlat(cfvar):
+    import numpy as np
+
+    # Return 2-D longitude and latitude arrays ordered as (Y, X) in the field data
+    y_axis = cfvar.get_data_axes(cfvar.dimension_coordinate('Y', key=True))[0]
+    x_axis = cfvar.get_data_axes(cfvar.dimension_coordinate('X', key=True))[0]
+
+    lat_key = cfvar.auxiliary_coordinate('latitude', key=True, default=None)
+    lon_key = cfvar.auxiliary_coordinate('longitude', key=True, default=None)
+    if lat_key is not None and lon_key is not None:
+        # Rotated pole or irregular grid: use the 2-D auxiliary coordinates
+        lat = cfvar.auxiliary_coordinate(lat_key).array
+        if tuple(cfvar.get_data_axes(lat_key)) == (x_axis, y_axis):
+            lat = lat.T
+        lon = cfvar.auxiliary_coordinate(lon_key).array
+        if tuple(cfvar.get_data_axes(lon_key)) == (x_axis, y_axis):
+            lon = lon.T
+    else:
+        # Regular grid: 1-D dimension coordinates
+        lon, lat = np.meshgrid(cfvar.dimension_coordinate('X').array, cfvar.dimension_coordinate('Y').array)
+
+    return lon, lat
+
+############################################################################################
+
+def cell_steps(xyz, axis):
+    import numpy as np
+
+    # Vector from one grid point to the next along axis (0: Y, 1: X) at each grid point:
+    # mean of the steps on both sides, one-sided on the edges, zero if the axis has a single point
+    steps = np.zeros(xyz.shape)
+    n = xyz.shape[axis]
+    if n < 2:
+        return steps
+    step = np.diff(xyz, axis=axis)
+    first = [slice(None)] * 3
+    last = [slice(None)] * 3
+    inner = [slice(None)] * 3
+    first[axis] = 0
+    last[axis] = n - 1
+    inner[axis] = slice(1, n - 1)
+    steps[tuple(first)] = step.take(0, axis=axis)
+    steps[tuple(last)] = step.take(n - 2, axis=axis)
+    steps[tuple(inner)] = (step.take(range(1, n - 1), axis=axis) + step.take(range(0, n - 2), axis=axis)) / 2.
+
+    return steps
+
+############################################################################################
+
+def get_grid_index(lon, lat):
+    import hashlib
+    import numpy as np
+    from scipy.spatial import cKDTree
+
+    # Identify the grid from its coordinates so that the tree is only built once
+    grid_key = hashlib.sha1(np.ascontiguousarray(lon).tobytes() + np.ascontiguousarray(lat).tobytes()).hexdigest()
+    if grid_key not in _grid_indexes:
+        xyz = lonlat_to_xyz(lon, lat)
+        # Local grid steps, used to find flight points beyond the bounds of the edge cells
+        y_steps = cell_steps(xyz, 0)
+        x_steps = cell_steps(xyz, 1)
+        # Global grids wrap around in longitude: the first and last columns are neighbours, not edges
+        periodic_x = False
+        if lon.shape[1] > 2:
+            wrap = np.linalg.norm(xyz[:, 0] - xyz[:, -1], axis=-1)
+            periodic_x = bool(np.all(wrap <= 1.5 * np.linalg.norm(x_steps[:, -1], axis=-1)))
+        _grid_indexes[grid_key] = (cKDTree(xyz.reshape(-1, 3)), xyz, y_steps, x_steps, periodic_x)
+
+    return _grid_indexes[grid_key]
+
+############################################################################################
+
+def outside_domain(grid_index, points_xyz, j, i):
+    import numpy as np
+
+    # Mask of points whose nearest grid point (j, i) is an edge cell and that lie more than half a
+    # local grid step beyond it (i.e. outside the bounds of the cell, outside the domain)
+    tree, xyz, y_steps, x_steps, periodic_x = grid_index
+    ny, nx = xyz.shape[:2]
+    offset = points_xyz - xyz[j, i]
+    outside = np.zeros(len(j), dtype=bool)
+    edges = [(y_steps, j, ny)]
+    if not periodic_x:
+        edges.append((x_steps, i, nx))
+    for steps, index, n in edges:
+        if n < 2:
+            continue
+        step = steps[j, i]
+        step_sq = np.sum(step * step, axis=-1)
+        # Offset along the grid axis, in units of the local grid step
+        along = np.sum(offset * step, axis=-1) / step_sq
+        outside |= ((index == 0) & (along < -0.5 - _EDGE_TOLERANCE)) | ((index == n - 1) & (along > 0.5 + _EDGE_TOLERANCE))
+
+    return outside
+
+############################################################################################
+
+def nearest_index(points, values):
+    import numpy as np
+
+    # Index of the nearest element of points (1-D, any order) for each value, and mask of values outside their range
+    points = np.asarray(points)
+    order = np.argsort(points)
+    sorted_points = points[order]
+    upper = np.clip(np.searchsorted(sorted_points, values), 1, max(len(points) - 1, 1))
+    lower = upper - 1
+    if len(points) == 1:
+        upper = lower
+    nearest = np.where(np.abs(values - sorted_points[lower]) <= np.abs(sorted_points[upper] - values), lower, upper)
+    outside = (values < sorted_points[0]) | (values > sorted_points[-1])
+
+    return order[nearest], outside
+
+############################################################################################
+
+def collocate_kdtree(cfvar, track, new_time_units):
+    import numpy as np
+    import cf_units
+    from cis.data_io.ungridded_data import UngriddedData, Metadata
+
+    # Horizontal: nearest grid point from the spatial index
+    lon, lat = grid_lonlat(cfvar)
+    grid_index = get_grid_index(lon, lat)
+    y_pos = axis_position(cfvar, 'Y')
+    x_pos = axis_position(cfvar, 'X')
+    points_xyz = lonlat_to_xyz(track.coord('longitude').data, track.coord('latitude').data)
+    distance, nearest = grid_index[0].query(points_xyz)
+    j, i = np.unravel_index(nearest, lon.shape)
+    mask = outside_domain(grid_index, points_xyz, j, i)
+
+    # Time: nearest model time (in the same units as the flight track)
+    t_pos = axis_position(cfvar, 'T')
+    t_coord = cfvar.dimension_coordinate('T')
+    model_times = cf_units.Unit(t_coord.units).convert(t_coord.array, new_time_units)
+    t_index, outside = nearest_index(model_times, track.coord('time').data)
+    mask = mask | outside
+
+    # Vertical: nearest level of the flight coordinate with the same standard name (e.g. air_pressure)
+    z_pos = axis_position(cfvar, 'Z')
+    if z_pos is not None and cfvar.shape[z_pos] > 1:
+        z_coord = cfvar.dimension_coordinate('Z')
+        track_z = track.coord(z_coord.standard_name)
+        track_z_data = cf_units.Unit(str(track_z.units)).convert(track_z.data, cf_units.Unit(z_coord.units))
+        k, outside = nearest_index(z_coord.array, track_z_data)
+        mask = mask | outside
+    else:
+        z_pos = None
+
+    # All other axes must be of size one
+    for n in range(cfvar.ndim):
+        if n not in (t_pos, z_pos, y_pos, x_pos) and cfvar.shape[n] > 1:
+            raise Exception('kdtree collocation only supports fields with time, vertical, latitude and longitude axes')
+
+    # Read one model time at the time and pick the nearest grid point for the flight points in it
+    values = np.ma.masked_all(mask.shape, dtype=np.float64)
+    for tt in np.unique(t_index[~mask]):
+        sel = np.where((t_index == tt) & ~mask)[0]
+        index = [slice(None)] * cfvar.ndim
+        index[t_pos] = slice(tt, tt + 1)
+        field_t = np.ma.asarray(cfvar[tuple(index)].data.array)
+        point_index = [0] * cfvar.ndim
+        point_index[y_pos] = j[sel]
+        point_index[x_pos] = i[sel]
+        if z_pos is not None:
+            point_index[z_pos] = k[sel]
+        values[sel] = field_t[tuple(point_index)]
+
+    s_name=None
+    if cfvar.has_property('standard_name'):
+        s_name=cfvar.get_property('standard_name')
+    l_name=None
+    if cfvar.has_property('long_name'):
+        l_name=cfvar.get_property('long_name')
+    units=''
+    if cfvar.has_property('units'):
+        units=cfvar.get_property('units')
+    metadata = Metadata(name=cfvar.get_property('um_stash_source'), standard_name=s_name, long_name=l_name,
+                        shape=values.shape, units=units)
+
+    return UngriddedData(data=values, metadata=metadata, coords=track.coords())
+
+############################################################################################
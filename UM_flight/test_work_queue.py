@@ -0,0 +1,124 @@
+#######################################################################################
+# Checks of the file-based work queue (work_queue.py) used for sharded execution of
+# UM_to_flightrack.py. Run with: python test_work_queue.py (or with pytest)
+#######################################################################################
+
+import os
+import sys
+import time
+import socket
+import tempfile
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from work_queue import init_queue, add_unit, claim_unit, complete_unit, fail_unit, queue_status
+
+N_UNITS = 200
+N_WORKERS = 8
+
+############################################################################################
+
+def _worker(queue_dir):
+    # Claim and complete units until the queue is empty; return the ids of the units claimed
+    claimed = []
+    while True:
+        unit = claim_unit(queue_dir, 'test_', lock_timeout=60)
+        if unit == None:
+            return claimed
+        unit_id, content = unit
+        claimed.append(unit_id)
+        complete_unit(queue_dir, unit_id, {'pid': os.getpid(), 'n': content['n']})
+
+############################################################################################
+
+def _new_queue(n_units):
+    queue_dir = tempfile.mkdtemp(prefix='work_queue_')
+    init_queue(queue_dir)
+    for n in range(n_units):
+        add_unit(queue_dir, 'test_{0:04d}'.format(n), {'n': n})
+
+    return queue_dir
+
+############################################################################################
+
+def test_each_unit_claimed_once():
+    queue_dir = _new_queue(N_UNITS)
+    with Pool(N_WORKERS) as pool:
+        claimed = [unit_id for worker_units in pool.map(_worker, [queue_dir] * N_WORKERS) for unit_id in worker_units]
+
+    assert len(claimed) == N_UNITS
+    assert len(set(claimed)) == N_UNITS
+    pending, stale, done, failed = queue_status(queue_dir, 'test_')
+    assert pending == [] and stale == {} and failed == {}
+    assert len(done) == N_UNITS
+    assert os.listdir(os.path.join(queue_dir, 'claimed')) == []
+    assert os.listdir(os.path.join(queue_dir, 'todo')) == []
+
+############################################################################################
+
+def test_requeue_after_deleting_done():
+    queue_dir = _new_queue(3)
+    assert sorted(_worker(queue_dir)) == ['test_0000', 'test_0001', 'test_0002']
+
+    # Running the coordinator again does not re-queue finished units
+    assert not add_unit(queue_dir, 'test_0001', {'n': 1})
+    os.remove(os.path.join(queue_dir, 'done', 'test_0001.json'))
+    assert add_unit(queue_dir, 'test_0001', {'n': 1})
+    assert _worker(queue_dir) == ['test_0001']
+    pending, stale, done, failed = queue_status(queue_dir, 'test_')
+    assert pending == [] and len(done) == 3
+
+############################################################################################
+
+def test_stale_lock_timeout():
+    queue_dir = _new_queue(1)
+    # Lock held by a process on another host that stopped touching it
+    lock_file = os.path.join(queue_dir, 'claimed', 'test_0000.lock')
+    with open(lock_file, 'w') as f:
+        f.write('other-host:12345')
+
+    assert claim_unit(queue_dir, 'test_', lock_timeout=60) == None
+    pending, stale, done, failed = queue_status(queue_dir, 'test_', lock_timeout=60)
+    assert pending == ['test_0000'] and stale == {}
+
+    old = time.time() - 120
+    os.utime(lock_file, (old, old))
+    pending, stale, done, failed = queue_status(queue_dir, 'test_', lock_timeout=60)
+    assert stale == {'test_0000': ('other-host', 12345)}
+    assert _worker(queue_dir) == ['test_0000']
+    assert os.listdir(os.path.join(queue_dir, 'claimed')) == []
+
+############################################################################################
+
+def test_stale_lock_dead_pid():
+    queue_dir = _new_queue(1)
+    # Lock held by a process on this host that is no longer running
+    with Pool(1) as pool:
+        dead_pid = pool.apply(os.getpid)
+    time.sleep(0.5)
+    with open(os.path.join(queue_dir, 'claimed', 'test_0000.lock'), 'w') as f:
+        f.write(socket.gethostname() + ':' + str(dead_pid))
+
+    assert _worker(queue_dir) == ['test_0000']
+
+############################################################################################
+
+def test_failed_unit_reported():
+    queue_dir = _new_queue(2)
+    unit_id, unit = claim_unit(queue_dir, 'test_')
+    fail_unit(queue_dir, unit_id, 'Traceback: something went wrong')
+
+    # The other unit is still processed and the failed one is not claimed again
+    assert _worker(queue_dir) == ['test_0001']
+    pending, stale, done, failed = queue_status(queue_dir, 'test_')
+    assert pending == [] and list(done) == ['test_0001']
+    assert failed[unit_id]['error'] == 'Traceback: something went wrong'
+    assert not add_unit(queue_dir, unit_id, unit)
+
+############################################################################################
+
+if __name__ == '__main__':
+    for test in [test_each_unit_claimed_once, test_requeue_after_deleting_done, test_stale_lock_timeout,
+                 test_stale_lock_dead_pid, test_failed_unit_reported]:
+        test()
+        print(test.__name__, ' passed')
@@ -0,0 +1,263 @@
+#######################################################################################
+# File-based work queue used by UM_to_flightrack.py to share work between independent
+# worker processes (on one or several nodes) through a plain shared POSIX filesystem.
+# No scheduler or service is needed: each work unit is a small json file and units are
+# claimed atomically by creating a lock file with O_CREAT|O_EXCL.
+#
+# Layout of the queue directory:
+#     queue_dir/todo/<unit_id>.json     work units written by the coordinator
+#     queue_dir/claimed/<unit_id>.lock  created by the worker processing the unit (contains host:pid)
+#     queue_dir/done/<unit_id>.json     result written by the worker when the unit is finished
+#     queue_dir/failed/<unit_id>.json   error written by the worker when the unit could not be processed
+#
+# Locks are leases: the worker touches its lock while it runs (keep_lease) and a lock that
+# has not been touched for lock_timeout seconds, or whose process is no longer running on
+# this host, is stale and the unit can be claimed again by another worker.
+# A finished unit can be re-queued by deleting its done file (a failed unit by deleting its
+# failed file) and running the coordinator again.
+#######################################################################################
+
+def init_queue(queue_dir):
+    import os
+
+    for subdir in ['todo', 'claimed', 'done', 'failed']:
+        os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+############################################################################################
+
+def _write_json(filename, content):
+    import json
+    import os
+
+    # Write to a temporary file first and rename it (atomic on POSIX) so readers never see partial files
+    tmpfile = filename + '.tmp' + str(os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmpfile, filename)
+
+############################################################################################
+
+def _is_finished(queue_dir, unit_id):
+    import os
+
+    return (os.path.exists(os.path.join(queue_dir, 'done', unit_id + '.json'))
+            or os.path.exists(os.path.join(queue_dir, 'failed', unit_id + '.json')))
+
+############################################################################################
+
+def _remove_todo(queue_dir, unit_id):
+    import os
+
+    try:
+        os.remove(os.path.join(queue_dir, 'todo', unit_id + '.json'))
+    except FileNotFoundError:
+        pass
+
+############################################################################################
+
+def add_unit(queue_dir, unit_id, unit):
+    import os
+
+    # Units already queued, finished or failed are left as they are, so the coordinator can be run again safely
+    todo_file = os.path.join(queue_dir, 'todo', unit_id + '.json')
+    if os.path.exists(todo_file) or _is_finished(queue_dir, unit_id):
+        return False
+    # A lock without todo or done file is left from a previous run of the unit (e.g. re-queued after deleting done)
+    release_unit(queue_dir, unit_id)
+    _write_json(todo_file, unit)
+
+    return True
+
+############################################################################################
+
+def lock_owner(queue_dir, unit_id):
+    import os
+
+    # Return (host, pid) written in the lock file, or None if the lock does not exist or cannot be read
+    try:
+        with open(os.path.join(queue_dir, 'claimed', unit_id + '.lock')) as f:
+            host, pid = f.read().strip().rsplit(':', 1)
+        return host, int(pid)
+    except (FileNotFoundError, ValueError):
+        return None
+
+############################################################################################
+
+def is_stale(queue_dir, unit_id, lock_timeout):
+    import os
+    import socket
+    import time
+
+    # A lock is stale if it has not been touched for lock_timeout seconds, or if its process has died on this host
+    lock_file = os.path.join(queue_dir, 'claimed', unit_id + '.lock')
+    try:
+        age = time.time() - os.stat(lock_file).st_mtime
+    except FileNotFoundError:
+        return False
+    if lock_timeout != None and age > lock_timeout:
+        return True
+    owner = lock_owner(queue_dir, unit_id)
+    if owner != None and owner[0] == socket.gethostname():
+        try:
+            os.kill(owner[1], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+
+    return False
+
+############################################################################################
+
+def _reclaim_stale_lock(queue_dir, unit_id, lock_timeout):
+    import os
+    import time
+
+    # Only one worker at a time may remove a stale lock: the removal is guarded by a second O_EXCL file
+    guard_file = os.path.join(queue_dir, 'claimed', unit_id + '.reclaim')
+    try:
+        fd = os.open(guard_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # Remove a guard left by a worker that died while reclaiming
+        try:
+            if lock_timeout != None and time.time() - os.stat(guard_file).st_mtime > lock_timeout:
+                os.remove(guard_file)
+        except FileNotFoundError:
+            pass
+        return False
+    os.close(fd)
+    try:
+        # Check again now that no other worker can be reclaiming the same lock
+        if not is_stale(queue_dir, unit_id, lock_timeout):
+            return False
+        owner = lock_owner(queue_dir, unit_id)
+        print('Reclaiming stale lock of work unit ', unit_id, ' held by ', owner)
+        release_unit(queue_dir, unit_id)
+        return True
+    finally:
+        os.remove(guard_file)
+
+############################################################################################
+
+def claim_unit(queue_dir, prefix='', lock_timeout=None):
+    import json
+    import os
+    import socket
+
+    # Return the first unit (whose id starts with prefix) that is not claimed or finished; None if there is none
+    for filename in sorted(os.listdir(os.path.join(queue_dir, 'todo'))):
+        if not filename.startswith(prefix) or not filename.endswith('.json'):
+            continue
+        unit_id = filename[:-len('.json')]
+        if _is_finished(queue_dir, unit_id):
+            # Leftover from a worker that stopped while completing the unit
+            _remove_todo(queue_dir, unit_id)
+            continue
+        lock_file = os.path.join(queue_dir, 'claimed', unit_id + '.lock')
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another worker holds the unit: take it over only if its lock is stale
+            if not _reclaim_stale_lock(queue_dir, unit_id, lock_timeout):
+                continue
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(socket.gethostname() + ':' + str(os.getpid()))
+        # The unit may have been completed (and its lock released) since it was listed
+        if _is_finished(queue_dir, unit_id):
+            release_unit(queue_dir, unit_id)
+            continue
+        try:
+            with open(os.path.join(queue_dir, 'todo', filename)) as f:
+                unit = json.load(f)
+        except FileNotFoundError:
+            release_unit(queue_dir, unit_id)
+            continue
+
+        return unit_id, unit
+
+    return None
+
+############################################################################################
+
+def keep_lease(queue_dir, unit_id, interval):
+    import os
+    import threading
+
+    # Touch the lock every interval seconds until the returned event is set
+    lock_file = os.path.join(queue_dir, 'claimed', unit_id + '.lock')
+    stop = threading.Event()
+
+    def touch():
+        while not stop.wait(interval):
+            try:
+                os.utime(lock_file)
+            except FileNotFoundError:
+                return
+
+    threading.Thread(target=touch, daemon=True).start()
+
+    return stop
+
+############################################################################################
+
+def complete_unit(queue_dir, unit_id, result):
+    import os
+
+    # The done file is written first: a unit with a done file is finished even if the steps below do not happen
+    _write_json(os.path.join(queue_dir, 'done', unit_id + '.json'), result)
+    _remove_todo(queue_dir, unit_id)
+    release_unit(queue_dir, unit_id)
+
+############################################################################################
+
+def fail_unit(queue_dir, unit_id, error):
+    import os
+    import socket
+
+    # Record the error so that other workers move on to the next unit and the merge step can report it
+    _write_json(os.path.join(queue_dir, 'failed', unit_id + '.json'),
+                {'error': error, 'host': socket.gethostname(), 'pid': os.getpid()})
+    _remove_todo(queue_dir, unit_id)
+    release_unit(queue_dir, unit_id)
+
+############################################################################################
+
+def release_unit(queue_dir, unit_id):
+    import os
+
+    # Remove the lock so that the unit can be claimed again (e.g. after a failure)
+    try:
+        os.remove(os.path.join(queue_dir, 'claimed', unit_id + '.lock'))
+    except FileNotFoundError:
+        pass
+
+############################################################################################
+
+def queue_status(queue_dir, prefix='', lock_timeout=None):
+    import json
+    import os
+
+    # Return, for units whose id starts with prefix:
+    #     pending: ids of units not finished yet (units with a done or failed file are finished even if their todo file is still there)
+    #     stale: {id: (host, pid)} of pending units whose lock is stale
+    #     done: {id: result} of finished units
+    #     failed: {id: error} of failed units
+    pending = [filename[:-len('.json')] for filename in sorted(os.listdir(os.path.join(queue_dir, 'todo')))
+               if filename.startswith(prefix) and filename.endswith('.json')
+               and not _is_finished(queue_dir, filename[:-len('.json')])]
+    stale = {unit_id: lock_owner(queue_dir, unit_id) for unit_id in pending if is_stale(queue_dir, unit_id, lock_timeout)}
+    results = {}
+    for subdir in ['done', 'failed']:
+        results[subdir] = {}
+        for filename in sorted(os.listdir(os.path.join(queue_dir, subdir))):
+            if filename.startswith(prefix) and filename.endswith('.json'):
+                with open(os.path.join(queue_dir, subdir, filename)) as f:
+                    results[subdir][filename[:-len('.json')]] = json.load(f)
+
+    return pending, stale, results['done'], results['failed']
+
+############################################################################################